@@ -9,10 +9,11 @@ Author:  Ross <peregrine dot warren at physics dot ox dot ac dot uk>
 import device  # Driver
 import config # adjustable parameters
 import sys
-import fnmatch
-import pandas as pd
-from PyQt5.QtCore import pyqtSignal, Qt, QObject
-from PyQt5.QtGui import QFont
+import time
+from collections import deque
+import numpy as np
+from PyQt5.QtCore import pyqtSignal, Qt, QObject, QTimer
+from PyQt5.QtGui import QFont, QTextCursor
 from PyQt5.QtWidgets import (QMainWindow, QDockWidget, QWidget, QDesktopWidget,
                              QApplication, QGridLayout, QPushButton, QLabel,
                              QDoubleSpinBox, QAction, qApp, QSizePolicy,
@@ -26,6 +27,19 @@ import matplotlib.style as style
 from matplotlib.figure import Figure
 
 matplotlib.use("Qt5Agg")
+style.use('ggplot')  # Looks the best?
+
+
+_SCREEN = None  # screen geometry, queried once per process
+
+
+def _screen_center(size):
+    """Return the top-left position that centres a window of given size."""
+    global _SCREEN
+    if _SCREEN is None:
+        _SCREEN = QDesktopWidget().screenGeometry()
+    return ((_SCREEN.width() - size.width()) // 2,
+            (_SCREEN.height() - size.height()) // 2)
 
 
 class mainWindow(QMainWindow):
@@ -61,7 +75,7 @@ class mainWindow(QMainWindow):
         self.dockConsole.setWidget(self.console)
         self.addDockWidget(Qt.RightDockWidgetArea, self.dockConsole)
         self.stdout_stream = EmittingStream()
-        self.stdout_stream.text_written.connect(self.console.console.append)
+        self.stdout_stream.text_written.connect(self.console.write)
         sys.stdout = self.stdout_stream
         sys.stderr = self.stdout_stream
 
@@ -97,14 +111,14 @@ class mainWindow(QMainWindow):
         keithleyAction = QAction('Settings', self)
         keithleyAction.setShortcut('Ctrl+K')
         keithleyAction.setStatusTip('Adjust scan parameters')
-        keithleyConAction = QAction('Connect', self)
-        keithleyConAction.setShortcut('Ctrl+J')
-        keithleyConAction.setStatusTip('Reconnect to keithley 2636')
+        self.keithleyConAction = QAction('Connect', self)
+        self.keithleyConAction.setShortcut('Ctrl+J')
+        self.keithleyConAction.setStatusTip('Reconnect to keithley 2636')
         keithleyAction.triggered.connect(self.keithleySettingsWindow.show)
-        keithleyConAction.triggered.connect(self.keithleyConnectionWindow.show)
-        keithleyError = QAction('Error Log', self)
-        keithleyError.setShortcut('Ctrl+E')
-        keithleyError.triggered.connect(self.keithleyErrorWindow.show)
+        self.keithleyConAction.triggered.connect(self.keithleyConnectionWindow.show)
+        self.keithleyErrorAction = QAction('Error Log', self)
+        self.keithleyErrorAction.setShortcut('Ctrl+E')
+        self.keithleyErrorAction.triggered.connect(self.keithleyErrorWindow.show)
 
         # Add items to menu bars
         menubar = self.menuBar()
@@ -115,16 +129,21 @@ class mainWindow(QMainWindow):
         fileMenu.addSeparator()
         fileMenu.addAction(exitAction)
         keithleyMenu = menubar.addMenu('&Keithley')
-        keithleyMenu.addAction(keithleyConAction)
+        keithleyMenu.addAction(self.keithleyConAction)
         keithleyMenu.addAction(keithleyAction)
-        keithleyMenu.addAction(keithleyError)
+        keithleyMenu.addAction(self.keithleyErrorAction)
 
         # Status bar setup
         self.statusbar = self.statusBar()
 
-        # Attempt to connect to a keithley
+        # Attempt to connect to a keithley, keeping the connection open
+        self.keithley = None
         self.testKeithleyConnection()
         self.keithleyConnectionWindow.connectionSig.connect(self.buttonWidget.showButtons)
+        self.keithleyConnectionWindow.connectionSig.connect(self.useReconnectedKeithley)
+        self.keithleyConnectionWindow.connectionFailedSig.connect(self.buttonWidget.hideButtons)
+        self.keithleyConnectionWindow.connectionFailedSig.connect(self.closeKeithley)
+        qApp.aboutToQuit.connect(self.closeKeithley)
 
         # Window setup
         self.resize(800, 800)
@@ -135,21 +154,40 @@ class mainWindow(QMainWindow):
     def testKeithleyConnection(self):
         """Connect to the keithley on initialisation."""
         try:
-            self.keithley = device.K2636(address=config.ADDRESS,
-                                        read_term='\n', baudrate=57600)
+            self.setKeithley(device.K2636(address=config.ADDRESS,
+                                          read_term='\n', baudrate=57600))
             self.statusbar.showMessage('Keithley found.')
             self.buttonWidget.showButtons()
-            self.keithley.closeConnection()
         except ConnectionError:
             self.buttonWidget.hideButtons()
             self.statusbar.showMessage('Not connected to Keithly. Check address and connection.')
 
+    def setKeithley(self, keithley):
+        """Share an open keithley connection with the popups."""
+        self.keithley = keithley
+        self.keithleyConnectionWindow.keithley = keithley
+        self.keithleyErrorWindow.keithley = keithley
+
+    def setInstrumentBusy(self, busy):
+        """Block reconnecting and error reads while a sweep uses the keithley."""
+        self.keithleyConAction.setEnabled(not busy)
+        self.keithleyErrorAction.setEnabled(not busy)
+        self.keithleyConnectionWindow.connButton.setEnabled(not busy)
+        self.keithleyErrorWindow.errorButton.setEnabled(not busy)
+
+    def useReconnectedKeithley(self):
+        """Adopt the connection made from the connection popup."""
+        self.setKeithley(self.keithleyConnectionWindow.keithley)
+
+    def closeKeithley(self):
+        """Close the shared keithley connection."""
+        if self.keithley is not None:
+            self.keithley.closeConnection()
+            self.setKeithley(None)
+
     def centre(self):
         """Find screen size and place in centre."""
-        screen = QDesktopWidget().screenGeometry()
-        size = self.geometry()
-        self.move((int(round(screen.width()-size.width())/2)),
-                    int(round((screen.height()-size.height())/2)))
+        self.move(*_screen_center(self.geometry()))
 
     def showFileOpen(self):
         """Pop up for file selection."""
@@ -157,12 +195,12 @@ class mainWindow(QMainWindow):
         fname = QFileDialog.getOpenFileName(self, 'Open file', filter=filt1)
         if fname[0]:
             try:
-                df = pd.read_csv(fname[0], sep='\t')
-                if fnmatch.fnmatch(fname[0], '*transfer.csv'):
+                if fname[0].endswith('transfer.csv'):
+                    df = device.readTransferCSV(fname[0])
                     self.mainWidget.drawTransfer(df)
                 else:
                     raise FileNotFoundError
-            except KeyError or FileNotFoundError:
+            except (KeyError, ValueError, FileNotFoundError):
                 self.popupWarning.showWindow('Unsupported file.')
 
     def showFileOpenALL(self):
@@ -172,11 +210,11 @@ class mainWindow(QMainWindow):
         if fname[0]:
             try:
                 fileN = fname[0]
-                if fnmatch.fnmatch(fname[0], '*transfer.csv'):
+                if fname[0].endswith('transfer.csv'):
                     fileN = fileN[:-21]
                 self.mainWidget.drawAll(fileN)
 
-            except KeyError or FileNotFoundError:
+            except (KeyError, FileNotFoundError):
                 self.popupWarning.showWindow('Unsupported file.')
 
 
@@ -243,7 +281,7 @@ class mplWidget(FigureCanvas):
 
     def initWidget(self, parent=None, width=5, height=4, dpi=100):
         """Set parameters of plotting widget."""
-        style.use('ggplot')  # Looks the best?
+        self._last_draw = 0.0  # time of last live redraw
 
         self.fig = Figure(figsize=(width, height), dpi=dpi)
         self.ax1 = self.fig.add_subplot(111)
@@ -251,6 +289,8 @@ class mplWidget(FigureCanvas):
         self.ax1.set_title('IV')
         self.ax1.set_xlabel('Channel Voltage [V]')
         self.ax1.set_ylabel('Channel Current [A]')
+        # Single persistent line, updated in place by drawTransfer
+        self._line, = self.ax1.semilogy([], [], '.-')
 
         FigureCanvas.__init__(self, self.fig)
         self.setParent(parent)
@@ -260,18 +300,31 @@ class mplWidget(FigureCanvas):
 
     def drawTransfer(self, df):
         """Take a data frame and draw it."""
-        self.ax1 = self.fig.add_subplot(111)
-        self.ax1.semilogy(df['Gate Voltage [V]'],
-                            abs(df['Channel Current [A]']), '.-')
+        self.drawLive(df['Gate Voltage [V]'].to_numpy(),
+                      df['Channel Current [A]'].to_numpy(), len(df))
+
+    def drawLive(self, gv, cc, n):
+        """Draw the first n points of gate voltage and current buffers."""
+        self._line.set_data(gv[:n], np.abs(cc[:n]))
         self.ax1.set_title('Transfer Curve')
         self.ax1.set_xlabel('Gate Voltage [V]')
         self.ax1.set_ylabel('Channel Current [A]')
-        FigureCanvas.draw(self)
+        self.ax1.relim()
+        self.ax1.autoscale_view()
+        self.draw_idle()
+
+    def updateLive(self, gv, cc, n):
+        """Redraw live data at most once per refresh interval."""
+        now = time.monotonic()
+        if now - self._last_draw < 0.05:  # 20 Hz
+            return
+        self._last_draw = now
+        self.drawLive(gv, cc, n)
 
     def clear(self):
         """Clear the plot."""
-        self.fig.clear()
-        FigureCanvas.draw(self)
+        self._line.set_data([], [])
+        self.draw_idle()
 
 
 class keithleySettingsWindow(QWidget):
@@ -329,19 +382,18 @@ class keithleySettingsWindow(QWidget):
 
     def centre(self):
         """Find screen size and place in centre."""
-        screen = QDesktopWidget().screenGeometry()
-        size = self.geometry()
-        self.move((int(round(screen.width()-size.width())/2)),
-                    (int(round(screen.height()-size.height())/2)))
+        self.move(*_screen_center(self.geometry()))
 
 class keithleyConnectionWindow(QWidget):
     """Popup for connecting to instrument."""
 
     connectionSig = pyqtSignal()
+    connectionFailedSig = pyqtSignal()
 
     def __init__(self):
         """Initialise setup."""
         super().__init__()
+        self.keithley = None  # shared connection, set by mainWindow
         self.initWidget()
 
     def initWidget(self):
@@ -366,24 +418,35 @@ class keithleyConnectionWindow(QWidget):
 
     def centre(self):
         """Find screen size and place in centre."""
-        screen = QDesktopWidget().screenGeometry()
-        size = self.geometry()
-        self.move((int(round(screen.width()-size.width()) / 2)),
-                    int(round((screen.height()-size.height()) / 2)))
+        self.move(*_screen_center(self.geometry()))
 
     def reconnect2keithley(self):
         """Reconnect to instrument."""
+        address = self.connAddress.text()
         try:
-            self.keithley = device.K2636(address=self.connAddress.text(),
+            # Keep an open connection to the same address only while it
+            # still answers; a dropped session is released and reopened
+            if (self.keithley is not None and config.ADDRESS == address
+                    and not self.keithley.isConnected()):
+                self.keithley.closeConnection()
+                self.keithley = None
+            if self.keithley is None or config.ADDRESS != address:
+                # Open the new connection before dropping the old one
+                keithley = device.K2636(address=address,
                                         read_term='\n', baudrate=57600)
+                if self.keithley is not None:
+                    self.keithley.closeConnection()
+                self.keithley = keithley
+                config.set_address(address)
             self.connStatus.setText('Connection successful')
             self.connectionSig.emit()
-            self.keithley.closeConnection()
-            if config.ADDRESS != self.connAddress.text():
-                config.set_address(self.connAddress.text())
 
         except ConnectionError:
             self.connStatus.setText('No Keithley can be found at specified address')
+            # Only a dropped session leaves mainWindow holding a closed
+            # handle; a failed open to a new address keeps the old one
+            if self.keithley is None:
+                self.connectionFailedSig.emit()
 
 
 
@@ -393,6 +456,7 @@ class keithleyErrorWindow(QWidget):
     def __init__(self):
         """Initialise setup."""
         super().__init__()
+        self.keithley = None  # shared connection, set by mainWindow
         self.initWidget()
 
     def initWidget(self):
@@ -415,22 +479,19 @@ class keithleyErrorWindow(QWidget):
 
     def centre(self):
         """Find screen size and place in centre."""
-        screen = QDesktopWidget().screenGeometry()
-        size = self.geometry()
-        self.move((int(round(screen.width()-size.width()) / 2)),
-                    int(round((screen.height()-size.height()) / 2)))
+        self.move(*_screen_center(self.geometry()))
 
     def readError(self):
-        """Reconnect to instrument."""
-        self.keithley = device.K2636(address='ASRL/dev/ttyUSB0',
-                                    read_term='\n', baudrate=57600)
+        """Read the next error from the shared instrument connection."""
+        if self.keithley is None:
+            self.errorStatus.append('CONNECTION ERROR: No connection established.')
+            return
 
         self.keithley._write('errorCode, message, severity, errorNode' +
                                 '= errorqueue.next()')
         self.keithley._write('print(errorCode, message)')
         error = self.keithley._query('')
         self.errorStatus.append(error)
-        self.keithley.closeConnection()
 
 
 class warningWindow(QWidget):
@@ -461,10 +522,7 @@ class warningWindow(QWidget):
 
     def centre(self):
         """Find screen size and place in centre."""
-        screen = QDesktopWidget().screenGeometry()
-        size = self.geometry()
-        self.move((int(round(screen.width()-size.width()) / 2)),
-                    int(round((screen.height()-size.height()) / 2)))
+        self.move(*_screen_center(self.geometry()))
 
     def showWindow(self, s):
         """Write error message and show window."""
@@ -480,8 +538,11 @@ class consoleStreamWidget(QWidget):
     def initWidget(self):
         grid = QGridLayout()
         self.setLayout(grid)
-        self.console = QTextEdit('Initialised console')
+        self.console = QTextEdit()
+        # setPlainText keeps the trailing newline the HTML constructor drops
+        self.console.setPlainText('Initialised console\n')
         self.console.setReadOnly(True)
+        self.console.document().setMaximumBlockCount(2000)  # cap scrollback
 
         font =  QFont("Courier New")
         font.setStyleHint(QFont.Monospace)
@@ -491,14 +552,31 @@ class consoleStreamWidget(QWidget):
 
         grid.addWidget(self.console, 0,0)
 
+    def write(self, text):
+        """Add text at the end of the console."""
+        self.console.moveCursor(QTextCursor.End)
+        self.console.insertPlainText(text)
+
 class EmittingStream(QObject):
+    """Buffer writes and emit them to the console every 100 ms."""
     text_written = pyqtSignal(str)
 
+    def __init__(self):
+        super().__init__()
+        self._buf = deque()
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.flush)
+        self._timer.start(100)
+
     def write(self, text):
-        self.text_written.emit(str(text))
+        self._buf.append(str(text))
 
     def flush(self):
-        pass
+        parts = []
+        while self._buf:
+            parts.append(self._buf.popleft())
+        if parts:
+            self.text_written.emit(''.join(parts))
 
 
 
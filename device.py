@@ -5,49 +5,135 @@ Author:  Ross <peregrine dot warren at physics dot ox dot ac dot uk>
 """
 
 import pyvisa as visa
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.style as style
 import time
+import os
+import re
 import serial
 import platform
+from functools import lru_cache
 
 import config # Used for parameters
 
 
-class UserCancelledError(Exception):
-    """Exception raised when user cancels measurement."""
-    pass
+_RM = None  # VISA resource manager shared by all connections
 
-class K2636():
-    """Class for Keithley control."""
 
-    def __init__(self, address=None, read_term='\n',
-                 baudrate=57600):
-        """Make instrument connection instantly on calling class."""
+def _resource_manager():
+    """Return the shared VISA resource manager, creating it on first use."""
+    global _RM
+    if _RM is None:
         if platform.system() == "Windows":
             try:
-                rm = visa.ResourceManager() # Pyvisa backend cannot be used, NI-VISA is used instead
+                _RM = visa.ResourceManager() # Pyvisa backend cannot be used, NI-VISA is used instead
             except:
                 raise ConnectionError("Cannot find VISA backend on Windows.")
         else:
             try:
-                 rm = visa.ResourceManager('@py')
+                _RM = visa.ResourceManager('@py')
             except:
                 raise ConnectionError("Cannot find PY-VISA backend on this machine")
+    return _RM
+
+
+# Address types the K2636 can be reached on
+_ADDR_OK = re.compile(r'ttyS|ttyUSB|USB')
+
+# Line prefixes printed by the TSP scripts during a sweep, as the first
+# two bytes packed into an int
+_SAMPLE_TAG = 0x4040  # b'@@'
+_END_TAG = 0x4545  # b'EE'
+
+
+@lru_cache(maxsize=16)
+def _load_tsp_bytes(path, mtime):
+    """Read a TSP script; mtime is part of the key so edits are picked up."""
+    with open(path, mode='rb') as f:
+        return f.read()
+
+
+def _tsp_mtime(tsp):
+    """Modification time of a TSP script, or None if it is missing."""
+    try:
+        return os.path.getmtime(str(config.TSP_DIR + tsp))
+    except OSError:
+        return None
+
+
+# Sweep data is kept as float32: the 2636B resolves about 6.5 digits, so
+# float32 and 7 significant digits in the csv lose nothing measurable
+DATA_FMT = '%.7g'
+
+# Columns of a sweep buffer, in the order printed by _PRINTBUFFER_ALL
+BUFFER_COLUMNS = ['Gate Voltage [V]', 'Channel Voltage [V]',
+                  'Channel Current [A]', 'Gate Leakage [A]']
+
+# One printbuffer call returns the four sweep buffers row by row
+_PRINTBUFFER_ALL = ('printbuffer(1, smua.nvbuffer1.n, '
+                    'smua.nvbuffer1.sourcevalues, smub.nvbuffer1.sourcevalues, '
+                    'smub.nvbuffer1.readings, smua.nvbuffer1.readings)')
+
+
+def _write_rows(f, arr, batch=4096):
+    """Write array rows as tab separated text, one write per batch."""
+    row_fmt = '\t'.join([DATA_FMT] * arr.shape[1]) + '\n'
+    for i in range(0, len(arr), batch):
+        f.write(''.join([row_fmt % tuple(row)
+                         for row in arr[i:i + batch].tolist()]))
+
+
+def _parse_ascii(resp):
+    """Parse a comma separated printbuffer reply."""
+    return np.fromstring(resp, sep=',', dtype=np.float32)
+
+
+# Columns plotted from a saved transfer csv
+TRANSFER_COLUMNS = ['Gate Voltage [V]', 'Channel Current [A]']
+
+
+def readTransferCSV(fname):
+    """Read the plotted columns of a saved transfer csv."""
+    return pd.read_csv(fname, sep='\t', engine='c', usecols=TRANSFER_COLUMNS,
+                       dtype={col: np.float32 for col in TRANSFER_COLUMNS},
+                       na_filter=False)
+
+
+class UserCancelledError(Exception):
+    """Exception raised when user cancels measurement."""
+    pass
+
+class K2636():
+    """Class for Keithley control."""
+
+    def __init__(self, address=None, read_term='\n',
+                 baudrate=57600, rm=None, chunk_size=65536, timeout=500000):
+        """Make instrument connection instantly on calling class.
+
+        chunk_size is the VISA read size in bytes; 64 KiB holds a whole
+        ASCII sweep buffer in one read, at the cost of a larger allocation
+        for small queries. timeout is in ms and must cover a full sweep.
+        """
+        if rm is None:
+            rm = _resource_manager()
 
         # Read address from device config
         if address is None:
             address = config.ADDRESS
-        self.makeConnection(rm, address, read_term, baudrate)
+        self.scripts = {}  # TSP file -> (script name, mtime) on the K2636
+        self.makeConnection(rm, address, read_term, baudrate,
+                            chunk_size, timeout)
 
-    def makeConnection(self, rm, address, read_term, baudrate):
+    def makeConnection(self, rm, address, read_term, baudrate,
+                       chunk_size=65536, timeout=500000):
         try:
-            if any(x in str(address) for x in ('ttyS', 'ttyUSB', 'USB')):
-                self.inst = rm.open_resource(config.ADDRESS)
+            if _ADDR_OK.search(address):
+                self.inst = rm.open_resource(address)
                 self.inst.read_termination = str(read_term)
+                self.inst.write_termination = '\n'
                 self.inst.baud_rate = baudrate
-                self.inst.timeout = 500000
+                self.inst.timeout = timeout
+                self.inst.chunk_size = chunk_size
             else:
                 raise ConnectionError("Unsupported address: {}".format(address))
         except:
@@ -65,6 +151,21 @@ class K2636():
         except(AttributeError):
             print('CONNECTION ERROR: No connection established.')
 
+        except visa.errors.Error:
+            print('CONNECTION ERROR: Connection already lost.')
+
+    def isConnected(self, timeout=2000):
+        """Check the instrument answers a trivial query within timeout ms."""
+        try:
+            old_timeout = self.inst.timeout
+            self.inst.timeout = timeout
+            try:
+                return bool(self.inst.query('print(1)').strip())
+            finally:
+                self.inst.timeout = old_timeout
+        except Exception:
+            return False
+
     def _write(self, m):
         """Write to instrument."""
         try:
@@ -73,6 +174,14 @@ class K2636():
         except AttributeError:
             print('CONNECTION ERROR: No connection established.')
 
+    def _write_raw(self, m):
+        """Write bytes to instrument as-is, without a termination."""
+        try:
+            assert type(m) == bytes
+            self.inst.write_raw(m)
+        except AttributeError:
+            print('CONNECTION ERROR: No connection established.')
+
     def _read(self):
         """Read instrument."""
         r = self.inst.read()
@@ -91,6 +200,18 @@ class K2636():
             print('CONNECTION ERROR: No connection established.')
             return ('CONNECTION ERROR: No connection established.')
         
+    def _query_bytes(self, s):
+        """Query instrument and return the undecoded reply."""
+        self._write(s)
+        return self.inst.read_raw()
+
+    def _query_binary(self, s, n):
+        """Query n single precision floats sent as a binary block."""
+        return self.inst.query_binary_values(s, datatype='f',
+                                             is_big_endian=False,
+                                             container=np.ndarray,
+                                             data_points=n)
+
     def cancelOperation(self):
         try:
             self._write("abort")
@@ -101,16 +222,15 @@ class K2636():
             print('CONNECTION ERROR: No connection established.')
             return ('CONNECTION ERROR: No connection established.')
 
-    def loadTSP(self, tsp):
-        """Load an anonymous TSP script into the K2636 nonvolatile memory."""
+    def loadTSP(self, tsp, name=''):
+        """Load a TSP script into the K2636 memory, anonymous unless named."""
         try:
-            tsp_dir = config.TSP_DIR
-            self._write('loadscript')
-            line_count = 1
-            for line in open(str(tsp_dir + tsp), mode='r'):
-                self._write(line)
-                line_count += 1
-            self._write('endscript')
+            path = str(config.TSP_DIR + tsp)
+            body = _load_tsp_bytes(path, os.path.getmtime(path))
+            # Send the whole script in one write rather than one per line
+            header = ('loadscript ' + name).rstrip().encode()
+            self._write_raw(header + b'\n' + body.rstrip(b'\n') +
+                            b'\nendscript\n')
             print('----------------------------------------')
             print('Uploaded TSP script: ', tsp)
 
@@ -118,79 +238,120 @@ class K2636():
             print('ERROR: Could not find tsp script. Check path: ' + config.TSP_DIR)
             raise SystemExit
 
-    def runTSP(self):
-        """Run the anonymous TSP script currently loaded in the K2636 memory."""
-        self._write('script.anonymous.run()')
+    def preloadScripts(self, scripts):
+        """Upload TSP scripts as named scripts, again only once edited."""
+        for tsp in scripts:
+            name = tsp.rsplit('.', 1)[0].replace('-', '_')
+            mtime = _tsp_mtime(tsp)
+            # A power cycled K2636 loses its scripts while the session lives
+            if (self.scripts.get(tsp) != (name, mtime)
+                    or not self.hasScript(name)):
+                self.loadTSP(tsp, name=name)
+                self.scripts[tsp] = (name, mtime)
+
+    def hasScript(self, name):
+        """Check a named script is still held in the K2636 memory."""
+        return self._query('print(' + name + ' ~= nil)').strip() == 'true'
+
+    def runTSP(self, name='script.anonymous'):
+        """Run a TSP script loaded in the K2636 memory."""
+        self._write(name + '.run()')
         print('Measurement in progress...')
 
     def readBuffer(self):
         """Read buffer in memory and return an array."""
         try:
-            vg = [float(x) for x in self._query('printbuffer' +
-                  '(1, smua.nvbuffer1.n, smua.nvbuffer1.sourcevalues)').split(',')]
-            ig = [float(x) for x in self._query('printbuffer' +
-                  '(1, smua.nvbuffer1.n, smua.nvbuffer1.readings)').split(',')]
-            vd = [float(x) for x in self._query('printbuffer' +
-                  '(1, smub.nvbuffer1.n, smub.nvbuffer1.sourcevalues)').split(',')]
-            c = [float(x) for x in self._query('printbuffer' +
-                 '(1, smub.nvbuffer1.n, smub.nvbuffer1.readings)').split(',')]
-
-            df = pd.DataFrame({'Gate Voltage [V]': vg,
-                               'Channel Voltage [V]': vd,
-                               'Channel Current [A]': c,
-                               'Gate Leakage [A]': ig})
+            n = int(float(self._query('print(smua.nvbuffer1.n)')))
+            # Transfer buffers as little endian single precision floats
+            self._write('format.data = format.SREAL')
+            self._write('format.byteorder = format.LITTLEENDIAN')
+            try:
+                arr = self._query_binary(_PRINTBUFFER_ALL, 4 * n)
+            except ValueError:
+                arr = None  # firmware without binary printbuffer output
+            finally:
+                self._write('format.data = format.ASCII')
+            if arr is None:
+                arr = _parse_ascii(self._query_bytes(_PRINTBUFFER_ALL))
+
+            # Wrap the (n, 4) block directly, already in column order
+            df = pd.DataFrame(arr.reshape(n, 4), columns=BUFFER_COLUMNS,
+                              copy=False)
             return df
 
         except serial.SerialException:
             print('Cannot read buffer.')
             return  
 
+    def _iter_lines(self):
+        """Yield lines printed by the instrument, reading in large chunks."""
+        buf = b''
+        while True:
+            buf += self.inst.read_bytes(self.inst.chunk_size,
+                                        break_on_termchar=True)
+            *lines, buf = buf.split(b'\n')
+            yield from lines
+
     def _readRealTimeData(self, cancel_check=None, data_callback=None):
         """
         Read real-time data from instrument and invoke callback.
         
         Args:
             cancel_check: Callable that returns True if cancellation is requested
-            data_callback: Callable to invoke with DataFrame updates
+            data_callback: Callable to invoke with (gate_voltages,
+                channel_currents, n) buffers; only the first n are filled
             
         Returns:
             DataFrame with collected data
         """
-        gate_voltages = []
-        channel_currents = []
-        
-        while True:
+        # One preallocated (gate voltage, channel current) block, grown
+        # geometrically when full
+        samples = np.empty((1024, 2), dtype=np.float32)
+        n = 0
+        last_print = 0.0  # console echo is limited to 10 lines a second
+
+        for line in self._iter_lines():
             # Cancellation handling
             if cancel_check is not None and cancel_check():
                 print('Cancel operation has been detected -> Aborting measurement')
                 self.cancelOperation()
                 raise UserCancelledError("Measurement cancelled by user")
 
-            line = self.inst.read()  # read single line printed from keithley
-            if line.strip().startswith("@@"):
-                data = line.strip()[2:].strip()  # Remove "@@" and extra whitespace
-                print("Realtime:", data)
-                values = data.split(',')
-                if len(values) >= 4:
-                    gate_voltages.append(float(values[0]))
-                    channel_currents.append(float(values[3]))
-                    
-                    # Emit real-time dataframe if callback provided
+            if len(line) < 2:
+                continue
+            tag = line[0] << 8 | line[1]
+            if tag == _SAMPLE_TAG:
+                data = line[2:]  # Remove "@@"
+                now = time.monotonic()
+                if now - last_print >= 0.1:
+                    last_print = now
+                    print("Realtime:", data.decode().strip())
+                # Only gate voltage (field 0) and channel current (field 3)
+                # are kept, so slice them out without splitting the line
+                i1 = data.find(b',')
+                i2 = data.find(b',', i1 + 1)
+                i3 = data.find(b',', i2 + 1)
+                if i1 != -1 and i2 != -1 and i3 != -1:
+                    if n == len(samples):
+                        # Copy into a fresh block so views already handed
+                        # to the callback stay valid
+                        samples = np.concatenate(
+                            (samples, np.empty_like(samples)))
+                    samples[n, 0] = float(data[:i1])
+                    samples[n, 1] = float(data[i3 + 1:])
+                    n += 1
+
+                    # Share column views of the block; the callback reads
+                    # the first n entries, which are never rewritten
                     if data_callback is not None:
-                        df_realtime = pd.DataFrame({
-                            'Gate Voltage [V]': gate_voltages,
-                            'Channel Current [A]': channel_currents
-                        })
-                        data_callback(df_realtime)
-            elif line.strip().startswith("EE"):  # Terminating characters
+                        data_callback(samples[:, 0], samples[:, 1], n)
+            elif tag == _END_TAG:  # Terminating characters
                 break
 
         # Return final dataframe
-        if gate_voltages and channel_currents:
-            df = pd.DataFrame({
-                'Gate Voltage [V]': gate_voltages,
-                'Channel Current [A]': channel_currents
-            })
+        if n:
+            df = pd.DataFrame(samples[:n], columns=TRANSFER_COLUMNS,
+                              copy=False)
             print(df)
             return df
         return None
@@ -200,33 +361,41 @@ class K2636():
         Execute a TSP script and collect real-time data.
         
         Args:
-            tsp_script: Path to TSP script file to load
+            tsp_script: TSP script file, uploaded on first use only
             cancel_check: Callable that returns True if cancellation is requested
-            data_callback: Callable to invoke with DataFrame updates
+            data_callback: Callable to invoke with realtime buffer updates
             
         Returns:
             DataFrame with collected data
         """
-        self.loadTSP(tsp_script)
-        self.runTSP()
+        self.preloadScripts([tsp_script])
+        self.runTSP(self.scripts[tsp_script][0])
         return self._readRealTimeData(cancel_check=cancel_check, data_callback=data_callback)
 
     def Transfer(self, sample, cancel_check=False, data_callback=None):
-        """K2636 Transfer sweeps."""
+        """K2636 Transfer sweeps, returning the saved buffer DataFrame."""
+        output_name = str(sample + '-transfer.csv')
+        part_name = output_name + '.part'
         try:
             begin_time = time.time()
-            
-            # Forward transfer scan
-            self._runTSPSweep(
-                'transfer-charact.tsp',
-                cancel_check=cancel_check,
-                data_callback=data_callback
-            )
-            transfer_df = self.readBuffer()
-            
+
+            # Open the output before measuring so a bad path fails before
+            # the sweep; an earlier result is only replaced once complete
+            with open(part_name, 'w') as f:
+                # Forward transfer scan
+                self._runTSPSweep(
+                    'transfer-charact.tsp',
+                    cancel_check=cancel_check,
+                    data_callback=data_callback
+                )
+                transfer_df = self.readBuffer()
+
+                if transfer_df is not None:
+                    f.write('\t'.join(BUFFER_COLUMNS) + '\n')
+                    # to_numpy() returns the read buffer itself, no copy
+                    _write_rows(f, transfer_df.to_numpy())
             if transfer_df is not None:
-                output_name = str(sample + '-transfer.csv')
-                transfer_df.to_csv(output_name, sep='\t', index=False)
+                os.replace(part_name, output_name)
 
             # # Reverse transfer scan
             # df_reverse = self._runTSPSweep(
@@ -242,6 +411,7 @@ class K2636():
             finish_time = time.time()
             print('Transfer curves measured. Elapsed time %.2f mins.'
                   % ((finish_time - begin_time) / 60))
+            return transfer_df
 
         except UserCancelledError:
             raise
@@ -249,7 +419,8 @@ class K2636():
             print('Cannot perform transfer sweep: no keithley connected.')
 
         finally:
-            pass
+            if os.path.exists(part_name):
+                os.remove(part_name)
 ########################################################################
 
 
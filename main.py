@@ -13,8 +13,8 @@ import GUI
 import device  # driver for keithly
 import sys
 import time
-import pandas as pd
-from PyQt5.QtCore import QThread, pyqtSignal
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from PyQt5.QtWidgets import QApplication
 from device import UserCancelledError
 
@@ -27,7 +27,7 @@ class GUI(GUI.mainWindow):
         super().__init__()
         self.params = {}  # for storing parameters
         self.measureThread = None
-        self.keithley = None
+        self._last_df = None  # data of the last finished sweep
         self.setupConnections()
 
     def setupConnections(self):
@@ -46,11 +46,10 @@ class GUI(GUI.mainWindow):
                 pass
         
         # Close instrument connection
-        if self.keithley:
-            try:
-                self.keithley.closeConnection()
-            except:
-                pass
+        try:
+            self.closeKeithley()
+        except:
+            pass
         
         # Accept the close event
         event.accept()
@@ -64,12 +63,12 @@ class GUI(GUI.mainWindow):
             except:
                 pass
         else:
-            try:
-                temp = device.K2636()
-                temp.cancelOperation()
-                temp.closeConnection()
-            except:
-                pass
+            # Send the abort on the open connection rather than a new one
+            if self.keithley is not None:
+                try:
+                    self.keithley.cancelOperation()
+                except:
+                    pass
             self.statusbar.showMessage('No operation to cancel')
 
     def transferSweep(self, event):
@@ -82,13 +81,19 @@ class GUI(GUI.mainWindow):
             self.buttonWidget.hideButtons()
             self.params['Measurement'] = 'transfer'
 
-            # Create a single K2636 instance and pass it to the worker thread so
-            # both GUI (cancel) and the thread operate on the same instrument.
-            self.keithley = device.K2636()
+            # Reuse the open K2636 connection and pass it to the worker thread
+            # so both GUI (cancel) and the thread operate on the same instrument.
+            if self.keithley is None:
+                self.setKeithley(device.K2636())
             self.measureThread = measureThread(self.params, self.keithley)
             self.measureThread.finishedSig.connect(self.done)
             self.measureThread.errorSig.connect(self.error)
-            self.measureThread.dataUpdateSig.connect(self.updateRealTimeDisplay)
+            # Samples are produced on the worker thread; queue them onto the
+            # GUI thread so plotting never runs inside the VISA read loop
+            self.measureThread.dataUpdateSig.connect(self.updateRealTimeDisplay,
+                                                     Qt.QueuedConnection)
+            # The sweep owns the shared session until it finishes
+            self.setInstrumentBusy(True)
             self.measureThread.start()
         except AttributeError:
             self.popupWarning.showWindow('No sample name given!')
@@ -96,26 +101,21 @@ class GUI(GUI.mainWindow):
     def done(self):
         """Update display when finished measurement."""
         self.statusbar.showMessage('Operations done')
-        if self.measureThread:
-            try:
-                if self.keithley:
-                    self.keithley.closeConnection()
-            except:
-                pass
-            self.keithley = None
+        self.setInstrumentBusy(False)
+        self._last_df = self.measureThread.result if self.measureThread else None
         self.dislpayMeasurement()
         self.buttonWidget.showButtons()
 
-    def updateRealTimeDisplay(self, df):
+    def updateRealTimeDisplay(self, gv, cc, n):
         """Update the plot with real-time data."""
-        if df is not None and not df.empty:
-            self.mainWidget.clear()
-            self.mainWidget.drawTransfer(df)
+        if n:
+            self.mainWidget.updateLive(gv, cc, n)
 
     def error(self, message):
         """Raise error warning."""
         self.popupWarning.showWindow(str(message))
         self.statusbar.showMessage('Measurement error!')
+        self.setInstrumentBusy(False)
         self.buttonWidget.hideButtons()
 
     def dislpayMeasurement(self): 
@@ -123,7 +123,11 @@ class GUI(GUI.mainWindow):
         try:
             # TRANSFER graph display
             if self.params['Measurement'] == 'transfer':
-                df = pd.read_csv(f"{self.params['Sample name']}-{self.params['Measurement']}.csv", sep='\t')
+                # Use the sweep still in memory; only read back from disk
+                # if there is none (e.g. the sweep was cancelled)
+                df = self._last_df
+                if df is None:
+                    df = device.readTransferCSV(f"{self.params['Sample name']}-{self.params['Measurement']}.csv")
                 self.mainWidget.clear()
                 self.mainWidget.drawTransfer(df)
 
@@ -137,7 +141,7 @@ class measureThread(QThread):
     finishedSig = pyqtSignal()
     errorSig = pyqtSignal(str)
     progressSig = pyqtSignal(str)
-    dataUpdateSig = pyqtSignal(pd.DataFrame)
+    dataUpdateSig = pyqtSignal(np.ndarray, np.ndarray, int)
 
     def __init__(self, params, keithley):
         """Initialise thread with params and a shared keithley instance."""
@@ -145,11 +149,20 @@ class measureThread(QThread):
         self.params = params
         self.keithley = keithley
         self._cancel_requested = False
+        self.result = None  # DataFrame returned by the sweep
+        self._last_emit = 0.0  # time of last realtime update sent
 
     def requestCancel(self):
         """Request cancellation: tell the instrument to abort and flag the thread."""
         self._cancel_requested = True
 
+    def _emitData(self, gv, cc, n):
+        """Send realtime buffers to the GUI at most 5 times a second."""
+        now = time.monotonic()
+        if now - self._last_emit >= 0.2:
+            self._last_emit = now
+            self.dataUpdateSig.emit(gv, cc, n)
+
     def __del__(self):
         """When thread is deconstructed wait for porcesses to complete."""
         self.wait()
@@ -164,10 +177,10 @@ class measureThread(QThread):
             begin_measure = time.time()
 
             if self.params['Measurement'] == 'transfer':
-                keithley.Transfer(
+                self.result = keithley.Transfer(
                     self.params['Sample name'],
                     cancel_check=lambda: self._cancel_requested,
-                    data_callback=lambda df: self.dataUpdateSig.emit(df)
+                    data_callback=self._emitData
                     )
 
             finish_measure = time.time()